@@ -12,9 +12,13 @@ setup(
     ],
     install_requires=[
         "password-strength>=0.0.3.post2",
-        "pexpect>=4.9.0",
         "pyzipper>=0.3.6"
     ],
+    extras_require={
+        'zlib-ng': [
+            "zlib-ng>=0.4.0"
+        ]
+    },
     python_requires='>=3.6.0',
     entry_points={
         'console_scripts': [
@@ -9,20 +9,48 @@ provide useful output files
 
 import argparse
 import atexit
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, \
+    ThreadPoolExecutor, wait
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+from functools import lru_cache
 from getpass import getpass
-from glob import glob
+import hashlib
+import json
+import multiprocessing
 import os
 from password_strength import PasswordPolicy
 from pathlib import PosixPath
-import pexpect
-import pyzipper
 import re
-from shutil import rmtree
+import selectors
+import shlex
+from shutil import copy2, copyfileobj, rmtree
 import subprocess
 import sys
+import threading
+import time
+from typing import Iterator, Optional
 import webbrowser
 import zipfile
+try:
+    from zlib_ng import zlib_ng as zlib
+except ImportError:
+    import zlib
+
+
+outputLock = threading.Lock()
+zipLock = threading.Lock()
+outputExts = ('json', 'log', 'csv', 'html')
+cacheRoot = PosixPath(os.getenv("XDG_CACHE_HOME") or
+                      os.path.expanduser("~/.cache")) / "tssl"
+headerRe = re.compile(r'^.+?: .+?$')
+fileNameTable = str.maketrans({'/': '_', ':': '_', ' ': None})
+compressionTypes = {'store': zipfile.ZIP_STORED,
+                    'deflate': zipfile.ZIP_DEFLATED,
+                    'lzma': zipfile.ZIP_LZMA}
+yesNoAnswers = {'y': True, 'yes': True, 'n': False, 'no': False, '': False}
+compressedExts = ('.zip', '.gz', '.bz2', '.xz', '.7z', '.png', '.jpg')
 
 
 def genParser() -> argparse.ArgumentParser:
@@ -35,6 +63,23 @@ def genParser() -> argparse.ArgumentParser:
     parser.add_argument('-c', '--command-only', action="store_true",
                         help="output the manual command only; do not scan",
                         dest="cmdOnly")
+    parser.add_argument('-C', '--cache', action="store", nargs="?",
+                        help="reuse results of identical scans run within " +
+                        "the cache TTL instead of rescanning, optionally " +
+                        "caching results in DIR (default: '~/.cache/tssl')",
+                        metavar="DIR", type=PosixPath, const=cacheRoot)
+    parser.add_argument('--cache-ttl', action="store", type=int,
+                        help="number of seconds cached results remain valid " +
+                        "for (default: 86400)", default=86400, dest="cacheTtl",
+                        metavar="SECONDS")
+    parser.add_argument('--certs-only', action="store_true",
+                        help="only check server defaults (including " +
+                        "certificates) and forward secrecy; much faster, but " +
+                        "output omits per-cipher results", dest="certsOnly")
+    parser.add_argument('--compression', action="store",
+                        choices=compressionTypes.keys(), default="deflate",
+                        help="compression method to use for zip archives " +
+                        "(default: deflate)")
     parser.add_argument('-d', '--directory', type=PosixPath, default='.',
                         help="directory to save output to instead of the " +
                         "current working directory", action="store")
@@ -49,6 +94,10 @@ def genParser() -> argparse.ArgumentParser:
                         help="HTTP header to add to all requests in the form " +
                         "'<name>: <value>' (can be specified multiple times " +
                         "per command)", dest="headers", metavar="HEADER")
+    parser.add_argument('-j', '--jobs', action="store", type=int,
+                        help="number of targets to scan concurrently " +
+                        "(default: number of CPUs, up to 8)",
+                        default=min(8, os.cpu_count() or 4))
     parser.add_argument('-l', '--label', action="store",
                         help="add a label to output files")
     existOptions.add_argument('-o', '--overwrite', action="store_true",
@@ -60,6 +109,12 @@ def genParser() -> argparse.ArgumentParser:
                         dest="testsslPath", default="testssl", metavar="PATH",
                         help="path of testssl executable (default: 'testssl')",
                         type=PosixPath)
+    parser.add_argument('-q', '--quiet', action="store_true",
+                        help="do not display testssl output while scanning")
+    parser.add_argument('--save-cmd', action="store_true",
+                        help="save the manual command for each target as a " +
+                        "shell script alongside its output files (always " +
+                        "done with -c/--command-only)", dest="saveCmd")
     existOptions.add_argument('-s', '--skip', action="store_true",
                               help="skip targets for which matching output " +
                               "files already exist")
@@ -69,8 +124,17 @@ def genParser() -> argparse.ArgumentParser:
     parser.add_argument('-u', '--url', nargs=1, action="extend",
                         help="URL to scan (can be specified multiple times " +
                         "per command)", dest="urls", metavar="URL")
+    parser.add_argument('--verify-zip', action="store_true",
+                        help="fully verify unencrypted zip archives " +
+                        "before removing the output directory (otherwise " +
+                        "only the archive's file listing is checked, " +
+                        "encrypted archives are always fully verified)",
+                        dest="verifyZip")
     parser.add_argument('-v', '--verbose', action="store_true",
                         help="display verbose output")
+    parser.add_argument('-y', '--assume-yes', action="store_true",
+                        help="answer yes to all confirmation prompts",
+                        dest="assumeYes")
     zipOptions.add_argument('-z', '--zip', action="store_true",
                             help="compress output directory into an " +
                             "unencrypted zip archive (includes existing files)")
@@ -85,23 +149,17 @@ def parseArgs() -> argparse.Namespace:
     if len(sys.argv) == 1:
         parser.print_help()
         sys.exit()
-    toCheck = []
-    for i in [args.files, args.urls, args.label, args.headers,
-              str(args.directory)]:
-        if i is not None:
-            toCheck.extend(i)
-    for string in toCheck:
-        if "'" in str(string):
-            sys.exit("Arguments cannot contain single quotes (')")
     if not args.urls and not args.files:
         sys.exit("Please specify at least one target using -u/--url and/or " +
                  "-f/--file")
+    if args.jobs < 1:
+        sys.exit("Number of concurrent jobs must be at least 1")
     args.directory = args.directory.resolve()
     if str(args.directory).endswith(".zip") and (args.zip or args.encrypt):
         args.directory = PosixPath(str(args.directory)[:-4])
     if not args.directory.exists():
         if yesNo(f"Output directory '{args.directory}' does not exist, create" +
-                 " it?"):
+                 " it?", args.assumeYes):
             mkdirs(args.directory)
         else:
             sys.exit()
@@ -110,65 +168,112 @@ def parseArgs() -> argparse.Namespace:
                  "directory")
     elif args.zip or args.encrypt:
         if not yesNo(f"Output directory '{args.directory}' exists, all " + 
-                     "contents will be compressed, continue?"):
+                     "contents will be compressed, continue?", args.assumeYes):
             sys.exit()
     if args.zip or args.encrypt:
         if PosixPath(f"{str(args.directory)}.zip").exists() and not \
             args.overwrite and not yesNo(f"Zip archive '{args.directory}.zip'" +
-                                         " exists, overwrite it?"):
+                                         " exists, overwrite it?",
+                                         args.assumeYes):
             sys.exit()
         if args.directory.resolve().samefile(os.getcwd()):
             sys.exit("Cannot zip the current directory, retry using " + 
                      "-d/--directory")
     if args.headers:
         for header in args.headers:
-            if not re.match(r'^.+?: .+?$', header):
+            if not headerRe.match(header):
                 sys.exit(f"'{header}' is not a valid header")
     if args.encrypt:
         passPolicy = PasswordPolicy.from_names(length=12, uppercase=1,
                                                numbers=1, special=1)
         while True:
             passw = getpass("Password for zip archive: ")
-            if not passPolicy.test(passw):
-                if getpass("Confirm password: ") == passw:
-                    args.passw = passw
-                    break
-                else:
-                    print("Passwords did not match, try again")
-            else:
+            if passPolicy.test(passw):
                 print("Passwords must be at least 12 characters long and " +
                       "contain at least 1 uppercase letter, 1 digit, and 1 " +
                       "special character")
-    targets = []
-    if args.urls:
-        for target in args.urls:
-            targets.append(target)
-    if args.files:
-        for target in args.files:
-            try:
-                target = PosixPath(target)
-            except:
-                sys.exit(f"'{target}' is not a valid file path")
-            if not target.exists():
-                sys.exit(f"Input file '{target}' does not exist")
-            with target.open() as f:
-                targets += f.read().splitlines()
-    args.targets = set(targets)
+                continue
+            if getpass("Confirm password: ") != passw:
+                print("Passwords did not match, try again")
+                continue
+            args.passw = passw
+            break
+    uniqueTargets = {}
+    numTargets = 0
+    for numTargets, target in enumerate(readTargets(args.urls or [],
+                                                    args.files or []), 1):
+        uniqueTargets.setdefault(canonicalTarget(target), target)
+    if not uniqueTargets:
+        sys.exit("No targets to scan")
+    if len(uniqueTargets) < numTargets:
+        print(f"Ignoring {numTargets - len(uniqueTargets)} duplicate " +
+              "target(s)")
+    args.targets = list(uniqueTargets.values())
     return args
 
-def yesNo(prompt: str) -> bool:
-        """Prompts the user for a yes/no response
-        @param prompt: Prompt to display to the user
-        @return: True if yes, False if no
-        """
-        yn = input(f"{prompt} (y/n): ")
-        if yn.lower() == 'y':
-            return True
-        elif yn.lower() == 'n':
+def readTargets(urls: list[str], files: list[str]) -> Iterator[str]:
+    """Reads targets from the command line and input files
+    @param urls: targets specified on the command line
+    @param files: newline delimited files containing targets
+    @return: iterator of targets, excluding blank lines
+    """
+    for target in urls:
+        target = target.strip()
+        if target:
+            yield target
+    for file in files:
+        try:
+            with open(file) as f:
+                for line in f:
+                    target = line.strip()
+                    if target:
+                        yield target
+        except FileNotFoundError:
+            sys.exit(f"Input file '{file}' does not exist")
+        except OSError:
+            sys.exit(f"Could not read input file '{file}'")
+
+def canonicalTarget(target: str) -> str:
+    """Normalises a target so that equivalent spellings compare equal
+    @param target: target to normalise
+    @return: target without scheme, trailing slashes, trailing dot in the
+    hostname, or default port (443) and with a lowercase host
+    """
+    host, sep, path = stripScheme(target.strip()).partition('/')
+    name, colon, port = host.lower().rpartition(':')
+    if not colon or (':' in name and not name.endswith(']')):
+        name, port = host.lower(), ''
+    name = name.rstrip('.')
+    if port and port != '443':
+        name = f"{name}:{port}"
+    return name + sep + path
+
+def stripScheme(target: str) -> str:
+    """Removes the scheme and any trailing slashes from a target
+    @param target: target to strip
+    @return: stripped target
+    """
+    target = target.rstrip('/')
+    scheme, sep, rest = target.partition("://")
+    return rest if sep and scheme else target
+
+def yesNo(prompt: str, assumeYes: bool = False) -> bool:
+    """Prompts the user for a yes/no response
+    @param prompt: Prompt to display to the user
+    @param assumeYes: answer yes without prompting
+    @return: True if yes, False if no (the default)
+    """
+    if assumeYes:
+        return True
+    while True:
+        try:
+            yn = yesNoAnswers.get(input(f"{prompt} (y/N): ").strip().lower())
+        except EOFError:
+            print()
             return False
-        else:
-            return yesNo(prompt)
-        
+        if yn is not None:
+            return yn
+
 def mkdirs(path: PosixPath) -> None:
     """Makes the directories in a given path"""
     try:
@@ -176,165 +281,570 @@ def mkdirs(path: PosixPath) -> None:
     except PermissionError:
         sys.exit(f"You do not have permission to write to '{path}'")
 
-def runTestssl(args: argparse.Namespace) -> list[str]:
-    """Runs testssl.sh and saves output files
+@lru_cache(maxsize=None)
+def getTestsslVersion(testsslPath: PosixPath) -> str:
+    """Gets the version banner of testssl.sh
+    @param testsslPath: path of testssl executable
+    @return: version banner
+    """
+    try:
+        return subprocess.run([str(testsslPath), '--version'],
+                              capture_output=True).stdout.decode()
+    except OSError:
+        sys.exit(f"Could not run testssl executable '{testsslPath}'")
+
+def getCacheKey(target: str, testsslCmd: list[str], ahaCmd: list[str]) -> str:
+    """Generates a key identifying the results of scanning a target
+    @param target: target to scan
+    @param testsslCmd: testssl.sh command, excluding output arguments
+    @param ahaCmd: aha command used to generate the HTML output
+    @return: hex digest identifying the scan
+    """
+    return hashlib.sha256(repr((target, testsslCmd, ahaCmd,
+                                getTestsslVersion(PosixPath(testsslCmd[0])))
+                               ).encode()).hexdigest()
+
+def loadCached(cacheDir: PosixPath, fileName: PosixPath, ttl: int) -> bool:
+    """Copies cached scan results to the output location if still valid
+    @param cacheDir: directory holding the cached results
+    @param fileName: output filename (without file extension)
+    @param ttl: number of seconds cached results remain valid for
+    @return: True if cached results were used, False otherwise
+    """
+    try:
+        with (cacheDir / "meta.json").open() as f:
+            if time.time() - json.load(f)["time"] > ttl:
+                return False
+        for ext in outputExts:
+            copy2(cacheDir / f"testssl.{ext}",
+                  fileName.with_name(f"{fileName.name}.{ext}"))
+    except (OSError, ValueError, KeyError):
+        return False
+    return True
+
+def saveCached(cacheDir: PosixPath, fileName: PosixPath, target: str) -> None:
+    """Copies scan results into the cache
+    @param cacheDir: directory to hold the cached results
+    @param fileName: output filename (without file extension)
+    @param target: scanned target
+    """
+    try:
+        cacheDir.mkdir(parents=True, exist_ok=True)
+        for ext in outputExts:
+            copy2(fileName.with_name(f"{fileName.name}.{ext}"),
+                  cacheDir / f"testssl.{ext}")
+        with (cacheDir / "meta.json").open('w') as f:
+            json.dump({"target": target, "time": time.time()}, f)
+    except OSError:
+        print(f"Could not cache results for '{target}'", file=sys.stderr)
+
+def genTestsslCmd(args: argparse.Namespace) -> list[str]:
+    """Generates the testssl.sh command shared by all targets
+    @param args: parsed CLI arguments object
+    @return: testssl.sh command, excluding output arguments and target
+    """
+    testsslTimeout = 0 if args.timeout <= 10 else args.timeout - 10
+    testsslCmd = [str(args.testsslPath), '--warnings', 'batch']
+    if not args.certsOnly:
+        testsslCmd.append('--wide')
+    testsslCmd += ['--sneaky', '--color', '3']
+    if args.verbose:
+        testsslCmd.append('--show-each')
+    if testsslTimeout:
+        testsslCmd += ['--connect-timeout', str(testsslTimeout),
+                       '--openssl-timeout', str(testsslTimeout)]
+    if args.headers:
+        for header in dict.fromkeys(args.headers):
+            testsslCmd += ['--reqheader', header]
+    if args.certsOnly:
+        testsslCmd += ['--server-defaults', '--fs']
+    else:
+        testsslCmd += ['-9', '-E']
+    return testsslCmd
+
+def planScans(args: argparse.Namespace) -> list[tuple[str, PosixPath,
+                                                       list[str]]]:
+    """Determines which targets to scan and where to save their output files
     @param args: parsed CLI arguments object
-    @return list of output filenames (without file extensions)
+    @return: list of targets to scan, their output paths (without file
+    extensions), and their existing output files
     """
     outDir = args.directory / "testssl"
     mkdirs(outDir)
-    outFiles = []
-    testsslTimeout = 0 if args.timeout <= 10 else args.timeout - 10
+    existing = defaultdict(list)
+    with os.scandir(outDir) as entries:
+        for entry in entries:
+            existing[entry.name.rsplit('.', 1)[0]].append(entry.path)
+    toScan = []
+    collisions = []
     for target in args.targets:
-        fileName = f"{outDir}/testssl_" + re.match(r'^(.+?://)?(.+?)$', 
-                   target.rstrip('/')).group(2).replace('/', '_').replace(' ', 
-                                                           '').replace(':', '_')
-        fileName = f"{fileName}_{args.label}" if args.label else fileName
-        existingOutput = glob(f"{fileName}*")
-        if existingOutput:
-            if args.overwrite:
-                for f in existingOutput:
-                    try:
-                        os.remove(f)
-                    except:
-                        sys.exit(f"Could not delete file '{f}'")
-            elif args.skip:
-                continue
-            else:
-                sys.exit(f"Output files for '{target}' already exist, " + 
-                         "rerun with -o/--overwrite to overwrite them or " +
-                         "-s/--skip to skip previously scanned hosts")
-        testsslCmd = [str(args.testsslPath), '--warnings', 'batch', '--wide',
-                      '--sneaky', '--color', '3', '-oJ', f"{fileName}.json",
-                      '-oL', f"{fileName}.log", '-oC', f"{fileName}.csv", '-9',
-                      '-E', target]
-        if args.verbose:
-            testsslCmd.insert(4, '--show-each')
-        if testsslTimeout:
-            testsslCmd.insert(4, '--connect-timeout')
-            testsslCmd.insert(5, str(testsslTimeout))
-            testsslCmd.insert(6, '--openssl-timeout')
-            testsslCmd.insert(7, str(testsslTimeout))
-        if args.headers:
-            for header in args.headers:
-                testsslCmd.insert(-9, '--reqheader')
-                testsslCmd.insert(-9, header)
-        htmlTitle = f"TestSSL - {target}"
-        htmlTitle = f"{htmlTitle} - {args.label}" if args.label else htmlTitle
-        ahaCmd = [str(args.ahaPath), '--black', '-t', htmlTitle]
-        cmd = ""
-        toQuote = [' ', '/', '\\', ':']
-        for i, arg in enumerate(testsslCmd):
-            if i == 0:
-                newArg = ""
-                for char in arg:
-                    if char in toQuote and char != "/":
-                        char = f"\{char}"
-                    newArg += char
-                arg = newArg
-            else:
-                for char in toQuote:
-                    if char in arg:
-                        arg = f"'{arg}'"
-                        break
-            cmd += f"{arg} "
-        cmd += "| tee >("
-        for i, arg in enumerate(ahaCmd):
-            if i == 0:
-                newArg = ""
-                for char in arg:
-                    if char in toQuote and char != "/":
-                        char = f"\{char}"
-                    newArg += char
-                arg = newArg
-            else:
-                for char in toQuote:
-                    if char in arg:
-                        arg = f"'{arg}'"
-                        break
-            cmd += f"{arg}"
-            if i != len(ahaCmd) - 1:
-                cmd += " "
-            else:
-                cmd += ")"
-        cmdOutFile = f"{fileName}.sh"
-        with open(cmdOutFile, 'w') as f:
-            f.write(cmd)
-        os.chmod(cmdOutFile, 0o755)
-        if args.cmdOnly:
-            print(f"{cmd}\n")
+        baseName = "testssl_" + stripScheme(target).translate(fileNameTable)
+        baseName = f"{baseName}_{args.label}" if args.label else baseName
+        fileName = outDir / baseName
+        existingOutput = existing.get(baseName, [])
+        if existingOutput and not args.overwrite:
+            if not args.skip:
+                collisions.append(target)
             continue
-        testsslOut = b''
-        run = True
-        while run:
-            testsslProc = pexpect.spawn(testsslCmd[0], testsslCmd[1:])
-            testsslProc.logfile = sys.stdout.buffer
-            while True:
-                try:
-                    testsslOut += testsslProc.read_nonblocking(
-                                                           timeout=args.timeout)
-                except pexpect.exceptions.TIMEOUT:
-                    testsslProc.close()
-                    if yesNo("\nCurrent scan timed out (process hung for " +
-                             f"{args.timeout} seconds), retry?"):
-                        for dudOutFile in glob(f"{fileName}.*"):
-                            os.remove(dudOutFile)
+        toScan.append((target, fileName, existingOutput))
+    if collisions:
+        sys.exit("Output files already exist for the following targets, " +
+                 "rerun with -o/--overwrite to overwrite them or -s/--skip " +
+                 "to skip previously scanned hosts:\n" + 
+                 "\n".join(f"  {target}" for target in collisions))
+    return toScan
+
+def runTestssl(args: argparse.Namespace,
+               toScan: list[tuple[str, PosixPath, list[str]]],
+               zip: Optional[zipfile.ZipFile] = None) -> list[PosixPath]:
+    """Runs testssl.sh against all targets and saves output files
+    @param args: parsed CLI arguments object
+    @param toScan: targets to scan, as returned by planScans
+    @param zip: zip archive to move each target's output files into once
+    scanned (output files are kept if None)
+    @return list of output paths (without file extensions)
+    """
+    testsslCmd = genTestsslCmd(args)
+    if args.cmdOnly:
+        for target, fileName, _ in toScan:
+            cmd = writeCmdScript(target, fileName, testsslCmd,
+                                 genAhaCmd(target, args))
+            print(f"{cmd}\n")
+        return []
+    workers = min(args.jobs, len(toScan))
+    if not workers:
+        return []
+    tee = workers == 1 and not args.quiet
+    arcDir = f"{args.directory.name}/testssl/"
+
+    def scan(target: str, fileName: PosixPath,
+             existingOutput: list[str]) -> tuple[Optional[PosixPath], bool]:
+        fileName, timedOut = scanTarget(target, fileName, existingOutput,
+                                        testsslCmd, args, tee)
+        if fileName and zip and not timedOut:
+            zipOutput(zip, fileName, arcDir)
+        return fileName, timedOut
+
+    outFiles = [None] * len(toScan)
+    retried = set()
+    hung = []
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        futures = {executor.submit(scan, *task): i
+                   for i, task in enumerate(toScan)}
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                i = futures.pop(future)
+                outFiles[i], timedOut = future.result()
+                if timedOut:
+                    hung.append(i)
+            while hung:
+                i = hung[0]
+                target, fileName, existingOutput = toScan[i]
+                timeoutMsg = f"\nScan of '{target}' timed out (process " + \
+                             f"hung for {args.timeout} seconds)"
+                with outputLock:
+                    if args.assumeYes:
+                        retry = i not in retried
+                        print(timeoutMsg + (", retrying..." if retry else ""))
                     else:
-                        run = False
+                        retry = yesNo(f"{timeoutMsg}, retry?")
+                hung.pop(0)
+                if retry:
+                    retried.add(i)
+                    futures[executor.submit(scan, *toScan[i])] = i
+                    continue
+                outFiles[i] = abandonScan(target, fileName, existingOutput)
+                if zip:
+                    zipOutput(zip, fileName, arcDir)
+    except KeyboardInterrupt:
+        executor.shutdown(wait=False, cancel_futures=True)
+        for i in hung:
+            target, fileName, existingOutput = toScan[i]
+            if existingOutput:
+                removeOutput(stagingName(fileName))
+        raise
+    executor.shutdown()
+    return [fileName for fileName in outFiles if fileName]
+
+def stopProcess(proc: subprocess.Popen, grace: int = 5) -> None:
+    """Asks a process to terminate, killing it if it does not exit in time
+    @param proc: process to stop
+    @param grace: number of seconds to wait before killing the process
+    """
+    proc.terminate()
+    try:
+        proc.wait(timeout=grace)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+
+def stagingName(fileName: PosixPath) -> PosixPath:
+    """Generates the filename a rescan is written to before it replaces
+    previous results
+    @param fileName: output filename (without file extension)
+    @return: staging filename (without file extension)
+    """
+    return fileName.with_name(f".{fileName.name}.new")
+
+def removeOutput(fileName: PosixPath) -> None:
+    """Removes the output files of a scan, ignoring any that do not exist
+    @param fileName: output filename (without file extension)
+    """
+    for ext in outputExts:
+        fileName.with_name(f"{fileName.name}.{ext}").unlink(missing_ok=True)
+
+def outputArgs(fileName: PosixPath) -> list[str]:
+    """Generates the testssl.sh arguments used to save output files
+    @param fileName: output filename (without file extension)
+    @return: list of testssl.sh arguments
+    """
+    return ['-oJ', f"{fileName}.json", '-oL', f"{fileName}.log", '-oC',
+            f"{fileName}.csv"]
+
+def genAhaCmd(target: str, args: argparse.Namespace) -> list[str]:
+    """Generates the aha command used to convert a target's output to HTML
+    @param target: target to scan
+    @param args: parsed CLI arguments object
+    @return: aha command
+    """
+    htmlTitle = f"TestSSL - {target}"
+    htmlTitle = f"{htmlTitle} - {args.label}" if args.label else htmlTitle
+    return [str(args.ahaPath), '--black', '-t', htmlTitle]
+
+def writeCmdScript(target: str, fileName: PosixPath, testsslCmd: list[str],
+                   ahaCmd: list[str]) -> str:
+    """Writes the manual command for scanning a target to a script
+    @param target: target to scan
+    @param fileName: output filename (without file extension)
+    @param testsslCmd: testssl.sh command, excluding output arguments and
+    target
+    @param ahaCmd: aha command used to generate the HTML output
+    @return: manual command
+    """
+    cmd = f"{shlex.join(testsslCmd + outputArgs(fileName) + [target])}" + \
+          f" | tee >({shlex.join(ahaCmd)} > " + \
+          f"{shlex.quote(f'{fileName}.html')})"
+    cmdOutFile = fileName.with_name(f"{fileName.name}.sh")
+    with open(cmdOutFile, 'w') as f:
+        f.write(f"#!/usr/bin/env bash\n{cmd}\n")
+    os.chmod(cmdOutFile, 0o755)
+    return cmd
+
+def scanTarget(target: str, fileName: PosixPath, existingOutput: list[str],
+               testsslCmd: list[str], args: argparse.Namespace,
+               tee: bool) -> tuple[Optional[PosixPath], bool]:
+    """Runs testssl.sh against a single target and saves output files, leaving
+    any output in place if the scan times out so it can be retried or
+    abandoned
+    @param target: target to scan
+    @param fileName: output filename (without file extension)
+    @param existingOutput: existing output files to replace if the scan
+    completes
+    @param testsslCmd: testssl.sh command, excluding output arguments and
+    target
+    @param args: parsed CLI arguments object
+    @param tee: whether to echo testssl.sh output to the terminal
+    @return output filename (without file extension), None if the scan
+    failed, and whether the scan timed out
+    """
+    ahaCmd = genAhaCmd(target, args)
+    if args.saveCmd:
+        writeCmdScript(target, fileName, testsslCmd, ahaCmd)
+    if args.cache:
+        cacheDir = args.cache / getCacheKey(target, testsslCmd, ahaCmd)
+        if loadCached(cacheDir, fileName, args.cacheTtl):
+            with outputLock:
+                print(f"Using cached results for '{target}'")
+            return fileName, False
+    if existingOutput:
+        runName = stagingName(fileName)
+    else:
+        runName = fileName
+    runCmd = testsslCmd + outputArgs(runName) + [target]
+    if not tee:
+        with outputLock:
+            print(f"Scanning '{target}'...")
+    removeOutput(runName)
+    ahaProc = testsslProc = None
+    try:
+        with open(runName.with_name(f"{runName.name}.html"), 'wb') as f:
+            ahaProc = subprocess.Popen(ahaCmd, stdin=subprocess.PIPE, stdout=f,
+                                       stderr=sys.stderr)
+        testsslProc = subprocess.Popen(runCmd, stdin=subprocess.DEVNULL,
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.STDOUT)
+        testsslFd = testsslProc.stdout.fileno()
+        splice = not tee and hasattr(os, "splice")
+        timedOut = False
+        with selectors.DefaultSelector() as selector:
+            selector.register(testsslFd, selectors.EVENT_READ)
+            while True:
+                if not selector.select(timeout=args.timeout):
+                    timedOut = True
+                    stopProcess(testsslProc)
                     break
-                except pexpect.exceptions.EOF:
-                    testsslProc.close()
-                    run = False
+                if splice:
+                    if not os.splice(testsslFd, ahaProc.stdin.fileno(),
+                                     65536):
+                        break
+                    continue
+                chunk = os.read(testsslFd, 65536)
+                if not chunk:
                     break
-        htmlFile = f"{fileName}.html"
-        with open(htmlFile, 'w') as f:
-            aha = subprocess.run(ahaCmd, input=testsslOut, stdout=f,
-                                 stderr=sys.stderr)
-        outFiles.append(fileName)
-    return outFiles
-
-def zipDir(path: PosixPath, passw: str = "") -> None:
-    """Zips a directory
-    @param path: path to the directory to zip
-    @param encrypt: password to use to encrypt the zip (not encrypted if empty)
+                ahaProc.stdin.write(chunk)
+                if tee:
+                    sys.stdout.buffer.write(chunk)
+                    sys.stdout.buffer.flush()
+        testsslProc.stdout.close()
+        rc = testsslProc.wait()
+        ahaProc.stdin.close()
+        ahaProc.wait()
+    except:
+        for proc in (testsslProc, ahaProc):
+            if proc and proc.poll() is None:
+                stopProcess(proc)
+        removeOutput(runName)
+        raise
+    if timedOut:
+        return fileName, True
+    if rc:
+        with outputLock:
+            print(f"Scan of '{target}' failed (testssl.sh exited with code " +
+                  f"{rc})")
+    if runName != fileName:
+        if rc:
+            removeOutput(runName)
+            with outputLock:
+                print(f"Keeping previous results for '{target}'")
+            return fileName, False
+        newOutput = {str(fileName.with_name(f"{fileName.name}.sh"))}
+        for ext in outputExts:
+            newFile = fileName.with_name(f"{fileName.name}.{ext}")
+            try:
+                os.replace(runName.with_name(f"{runName.name}.{ext}"),
+                           newFile)
+            except FileNotFoundError:
+                continue
+            except OSError:
+                sys.exit(f"Could not replace file '{newFile}'")
+            newOutput.add(str(newFile))
+        for f in existingOutput:
+            if f not in newOutput:
+                try:
+                    os.remove(f)
+                except FileNotFoundError:
+                    pass
+                except OSError:
+                    sys.exit(f"Could not delete file '{f}'")
+    elif rc:
+        return None, False
+    if args.cache and rc == 0:
+        saveCached(cacheDir, fileName, target)
+    if not tee:
+        with outputLock:
+            print(f"Finished scanning '{target}'")
+    return fileName, False
+
+def abandonScan(target: str, fileName: PosixPath,
+                existingOutput: list[str]) -> PosixPath:
+    """Gives up on a timed out scan, restoring previous results if there were
+    any and keeping partial output otherwise
+    @param target: target that was scanned
+    @param fileName: output filename (without file extension)
+    @param existingOutput: existing output files the scan was to replace
+    @return: output filename (without file extension)
     """
+    with outputLock:
+        if existingOutput:
+            removeOutput(stagingName(fileName))
+            print(f"Keeping previous results for '{target}'")
+        else:
+            print(f"Scan of '{target}' abandoned")
+    return fileName
+
+def walkFiles(path: str, prefixLen: int) -> Iterator[tuple[str, str]]:
+    """Recursively lists the files in a directory
+    @param path: path to the directory to list
+    @param prefixLen: length of the path prefix to remove to give archive names
+    @return: iterator of file paths and their archive names
+    """
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from walkFiles(entry.path, prefixLen)
+            elif not entry.is_dir():
+                yield entry.path, entry.path[prefixLen:]
+
+@contextmanager
+def openSequential(path: str) -> Iterator:
+    """Opens a file that will be read once from start to end, hinting the
+    kernel to read ahead and to drop its cached pages afterwards
+    @param path: path of the file to open
+    @return: binary file object for the file
+    """
+    fd = os.open(path, os.O_RDONLY)
+    if hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    try:
+        with os.fdopen(fd, 'rb', buffering=1 << 20, closefd=False) as f:
+            yield f
+    finally:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        os.close(fd)
+
+def deflateFile(path: str) -> tuple[int, int, bytes]:
+    """Compresses a file into a raw DEFLATE stream for a zip archive
+    @param path: path of the file to compress
+    @return: CRC-32 and size of the file, and the compressed data
+    """
+    with openSequential(path) as f:
+        data = f.read()
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED,
+                                  -zlib.MAX_WBITS)
+    return (zlib.crc32(data), len(data),
+            compressor.compress(data) + compressor.flush())
+
+def writeDeflated(zip: zipfile.ZipFile, path: str, arcName: str, crc: int,
+                  size: int, data: bytes) -> None:
+    """Writes a file compressed by deflateFile into a zip archive
+    @param zip: zip archive open for writing
+    @param path: path of the original file
+    @param arcName: name of the file within the archive
+    @param crc: CRC-32 of the original file
+    @param size: size of the original file
+    @param data: compressed data
+    """
+    zinfo = zipfile.ZipInfo.from_file(path, arcName)
+    zinfo.compress_type = zipfile.ZIP_DEFLATED
+    zinfo.CRC = crc
+    zinfo.file_size = size
+    zinfo.compress_size = len(data)
+    with zip._lock:
+        zip.fp.seek(zip.start_dir)
+        zinfo.header_offset = zip.fp.tell()
+        zip._writecheck(zinfo)
+        zip._didModify = True
+        zip.fp.write(zinfo.FileHeader())
+        zip.fp.write(data)
+        zip.filelist.append(zinfo)
+        zip.NameToInfo[zinfo.filename] = zinfo
+        zip.start_dir = zip.fp.tell()
+
+def createZip(path: PosixPath, passw: str = "",
+              compression: int = zipfile.ZIP_DEFLATED) -> zipfile.ZipFile:
+    """Creates a zip archive alongside a directory
+    @param path: path to the directory the archive is for
+    @param passw: password to use to encrypt the zip (not encrypted if empty)
+    @param compression: compression method to use for files that are not
+    already compressed
+    @return: zip archive open for writing
+    """
+    if passw:
+        import pyzipper
     print("Creating zip archive...")
-    path = path.resolve()
-    passw = bytes(passw, "utf-8")
     zipName = f"{path}.zip"
     try:
         if passw:
             zip = pyzipper.AESZipFile(zipName, 'w',
-                                      compression=pyzipper.ZIP_LZMA,
+                                      compression=compression,
                                       encryption=pyzipper.WZ_AES)
-            zip.setpassword(passw)
+            zip.setpassword(bytes(passw, "utf-8"))
         else:
-            zip = zipfile.ZipFile(zipName, 'w', compression=zipfile.ZIP_LZMA)
-        atexit.register(zip.close)
-        for root, dirs, files in os.walk(path):
-            for file in files:
-                zip.write(os.path.join(root, file),
-                        os.path.relpath(os.path.join(root, file), 
-                                        os.path.join(path, '..')))
+            zip = zipfile.ZipFile(zipName, 'w', compression=compression)
     except:
         sys.exit(f"Could not create zip archive '{zipName}'")
-    print("Verifying zip archive...")
+    atexit.register(zip.close)
+    return zip
+
+def addToZip(zip: zipfile.ZipFile, path: str, arcName: str) -> None:
+    """Streams a file into a zip archive, storing already compressed files
+    without compressing them again
+    @param zip: zip archive open for writing
+    @param path: path of the file to add
+    @param arcName: name of the file within the archive
+    """
+    zinfo = getattr(zip, "zipinfo_cls", zipfile.ZipInfo).from_file(path,
+                                                                   arcName)
+    zinfo.compress_type = zipfile.ZIP_STORED if \
+        path.lower().endswith(compressedExts) else zip.compression
+    with openSequential(path) as src, zip.open(zinfo, 'w') as dst:
+        copyfileobj(src, dst, 1 << 20)
+
+def zipOutput(zip: zipfile.ZipFile, fileName: PosixPath, arcDir: str) -> None:
+    """Moves the output files of a scan into a zip archive
+    @param zip: zip archive open for writing
+    @param fileName: output filename (without file extension)
+    @param arcDir: directory within the archive to add the files to
+    """
+    with zipLock:
+        for ext in outputExts + ('sh',):
+            outFile = fileName.with_name(f"{fileName.name}.{ext}")
+            if not outFile.exists():
+                continue
+            try:
+                addToZip(zip, str(outFile), arcDir + outFile.name)
+                outFile.unlink()
+            except OSError:
+                sys.exit(f"Could not add '{outFile}' to zip archive " +
+                         f"'{zip.filename}'")
+
+def zipDir(path: PosixPath, zip: zipfile.ZipFile, passw: str = "",
+           verify: bool = False) -> None:
+    """Adds the remaining contents of a directory to its zip archive, then
+    removes the directory
+    @param path: path to the directory to zip
+    @param zip: zip archive created for the directory by createZip
+    @param passw: password the zip is encrypted with (not encrypted if empty)
+    @param verify: check the CRC of every file in the zip before removing the
+    directory (always done for encrypted zips, otherwise only the zip's
+    central directory is checked)
+    """
     if passw:
+        import pyzipper
+    passw = bytes(passw, "utf-8")
+    zipName = zip.filename
+    try:
+        toZip = list(walkFiles(str(path),
+                               len(os.path.join(str(path.parent), ''))))
+        with ProcessPoolExecutor(mp_context=multiprocessing.get_context(
+                "fork" if sys.platform == "linux" else None)) as executor:
+            deflated = {}
+            if not passw and zip.compression == zipfile.ZIP_DEFLATED:
+                for filePath, arcName in toZip:
+                    if not filePath.lower().endswith(compressedExts):
+                        deflated[filePath] = executor.submit(deflateFile,
+                                                             filePath)
+            for filePath, arcName in toZip:
+                if filePath in deflated:
+                    writeDeflated(zip, filePath, arcName,
+                                  *deflated[filePath].result())
+                else:
+                    addToZip(zip, filePath, arcName)
+        numFiles = len(zip.infolist())
         zip.close()
         atexit.unregister(zip.close)
-        zip = pyzipper.AESZipFile(zipName, 'r')
-        atexit.register(zip.close)
-        zip.setpassword(passw)
-    if zip.testzip() is None:
-        zip.close()
-        atexit.unregister(zip.close)
-        print("Removing output directory...")
-        try:
-            rmtree(path)
-        except:
-            sys.exit(f"Could not remove directory '{path}'")
-    else:
+    except:
+        sys.exit(f"Could not create zip archive '{zipName}'")
+    print("Verifying zip archive...")
+    try:
+        if passw:
+            zip = pyzipper.AESZipFile(zipName, 'r')
+            zip.setpassword(passw)
+        else:
+            zip = zipfile.ZipFile(zipName, 'r')
+        with zip:
+            if len(zip.infolist()) != numFiles or \
+               (passw or verify) and zip.testzip() is not None:
+                raise zipfile.BadZipFile
+    except:
         sys.exit(f"Zip archive '{zipName}' corrupted")
+    print("Removing output directory...")
+    try:
+        rmtree(path)
+    except:
+        sys.exit(f"Could not remove directory '{path}'")
     print(f"Output directory compressed to '{zipName}'")
 
 def main() -> None:
@@ -342,11 +852,19 @@ def main() -> None:
     try:
         docker = True if os.getenv("TSSL_DOCKER") else False
         args = parseArgs()
+        toScan = planScans(args)
+        zip = None
+        if args.zip:
+            zip = createZip(args.directory,
+                            compression=compressionTypes[args.compression])
+        elif args.encrypt:
+            zip = createZip(args.directory, args.passw,
+                            compressionTypes[args.compression])
         if not args.cmdOnly:
             startTime = datetime.now()
             print("Starting scan at " +
                   f"{startTime.strftime('%d/%m/%Y - %H:%M:%S')}")
-        outFiles = runTestssl(args)
+        outFiles = runTestssl(args, toScan, zip)
         if not args.cmdOnly:
             endTime = datetime.now()
             dur = endTime - startTime
@@ -355,9 +873,9 @@ def main() -> None:
                 f"{endTime.strftime('%d/%m/%Y - %H:%M:%S')} " +
                 f"(Duration: {str(dur)})")
         if args.zip:
-            zipDir(args.directory)
+            zipDir(args.directory, zip, verify=args.verifyZip)
         elif args.encrypt:
-            zipDir(args.directory, args.passw)
+            zipDir(args.directory, zip, args.passw, args.verifyZip)
         else:
             print(f"Output files written to '{args.directory}'")
             if outFiles and not docker and not args.cmdOnly and \